@@ -1,400 +1,826 @@
+import asyncio
+import bisect
+import functools
+import hashlib
+import json
+import logging
 import os
+import re
 import sys
-from openai import OpenAI
-from github import Github
-
-MAX_INPUT_LENGTH = 30000  # Maximum length (characters) of the input diff
-MAX_OUTPUT_TOKENS = 2000
-TEMPERATURE = 0.3
-MODEL = "gpt-4o-mini"
-FORCE_REVIEW = False
-LINES_CHANGE_THRESHOLD = 10
-
-def validate_environment():
-    """Validate that all required environment variables are set."""
-    required_vars = ["OPENAI_API_KEY", "GIT_TOKEN", "GIT_REPOSITORY", "PR_NUMBER"]
-    missing_vars = []
-    
-    for var in required_vars:
-        if not os.environ.get(var):
-            missing_vars.append(var)
-    
-    if missing_vars:
-        print(f"❌ Missing required environment variables: {', '.join(missing_vars)}")
-        sys.exit(1)
+import tempfile
+import httpx
+import tiktoken
+from collections import namedtuple
+from dataclasses import dataclass
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
+from openai.types.chat import ChatCompletion
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+log = logging.getLogger(__name__)
+
+LLM_CACHE_DIR = os.path.join(".cache", "llm")
+COMPARE_CACHE_DIR = os.path.join(".cache", "compare")
+ETAG_CACHE_DIR = os.path.join(".cache", "etag")
+GITHUB_API_URL = "https://api.github.com"
+FILES_PER_PAGE = 100  # GitHub's maximum page size for PR files
+
+SYSTEM_PROMPT_BASE = """You are an expert GitHub code reviewer.
+You are also a senior software & AI engineer with 10+ years of experience in machine learning, Python, and PyTorch.
+Provide constructive feedback on the PR diff.
+Deliver a compact, information-dense response and Focus on key points only.
+Focus on code quality, best practices, potential bugs, and improvement suggestions.
+If you are satisfied with the PR, you can just say "🤖 I'm satisfied with the PR".
+NOTE: Your response must be in Korean, but retain technical terms (e.g., PR, Github, CI, Docker, etc.) and the names of variables, functions, etc., in English.
+Here is the enhanced format for the review:
+1. **Summary of the PR**: Provide a brief overview of the purpose and scope of the pull request.
+2. **What's Changed?**: Highlight the key changes made in the codebase.
+3. **Improvement Suggestions**: Offer constructive feedback on how the code can be improved.
+4. **Code Quality**: Assess the readability, maintainability, and efficiency of the code.
+5. **Best Practices**: Evaluate adherence to coding standards and industry best practices.
+6. **Potential Bugs**: Identify any potential issues or bugs in the code.
+
+In addition to the review, provide specific line-by-line suggestions. For each suggestion, provide:
+1. The filename where the change should be made
+2. The exact line number (in the new version of the file) where the change should be made
+3. The specific code change or suggestion
+4. A brief explanation of why this change is needed
+Only provide suggestions for actual issues that need fixing. If no specific line changes are needed, return an empty list.
+
+Format your response as a JSON object:
+{
+  "review_markdown": "<the review in the format above>",
+  "suggestions": [
+    {
+      "file": "<filename>",
+      "line": <line_number>,
+      "suggestion": "<specific code suggestion>",
+      "explanation": "<brief explanation>"
+    }
+  ]
+}
+"""
+# 7. **Testing and Validation**: Comment on the adequacy of tests and validation methods used.
+# 8. **Documentation**: Review the quality and completeness of documentation provided.
+
+FOLLOWUP_ADDENDUM = """IMPORTANT: This is a follow-up review.
+The diff represents changes since the last review.
+Consider previous feedback and provide updated suggestions based on new changes.
+Focus on what has changed since the last review.
+Avoid repeating content from the previous review.
+Identify and indicate which prior suggestions have been implemented and which require further attention.
+Use ✅ to denote implemented suggestions and ❌ for those not yet addressed."""
+
+# Overrides the JSON format requested by SYSTEM_PROMPT_BASE when structured output failed
+REVIEW_ONLY_ADDENDUM = """IMPORTANT: Respond with the review in markdown only.
+Do not include line-specific suggestions and do not wrap the response in JSON."""
+
+# Structured output schema enforced server-side for the review and line-specific suggestions
+REVIEW_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "review",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "review_markdown": {"type": "string"},
+                "suggestions": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "file": {"type": "string"},
+                            "line": {"type": "integer"},
+                            "suggestion": {"type": "string"},
+                            "explanation": {"type": "string"}
+                        },
+                        "required": ["file", "line", "suggestion", "explanation"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["review_markdown", "suggestions"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Recent reviews plus per-commit line counts, so the change threshold can be checked without fetching patches
+REVIEW_STATE_QUERY = """
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      reviews(last: 50) {
+        nodes { databaseId body submittedAt commit { oid } }
+      }
+      commits(last: 100) {
+        nodes { commit { oid additions deletions } }
+      }
+    }
+  }
+}
+"""
+
+# Minimal view of a PR review, as returned by REVIEW_STATE_QUERY.
+# `changes_since` is (additions, deletions) over the commits after the review, or None if they were not all fetched.
+AgentReview = namedtuple("AgentReview", ["id", "body", "commit_id", "submitted_at", "changes_since"])
+
+# Body of an inline suggestion comment, filled directly from a suggestion dict
+SUGGESTION_COMMENT_TEMPLATE = "🤖 **Suggestion:**\n```\n{suggestion}\n```\n\n**Reason:** {explanation}"
+
+# Splits a file patch before each "@@ " hunk header, keeping the header with its hunk
+HUNK_SPLIT_PATTERN = re.compile(r"\n(?=@@ )")
+
+# Hunk header, capturing the first line number of the new file side
+HUNK_HEADER_PATTERN = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
+# Lines of a previous review worth keeping as context: list items, headings and ✅/❌ markers
+REVIEW_KEY_LINE_PATTERN = re.compile(r"^\s*(?:[-*] |\d+\.|#+ |✅|❌)")
+
+def is_rate_limited(exc):
+    """Return True if a GitHub request was rejected by a rate limit."""
+    if not isinstance(exc, httpx.HTTPStatusError):
+        return False
+    response = exc.response
+    # GitHub reports primary and secondary rate limits as 403 with rate limit headers
+    return response.status_code == 429 or (
+        response.status_code == 403
+        and (response.headers.get("x-ratelimit-remaining") == "0" or "retry-after" in response.headers)
+    )
+
+def is_retryable_error(exc):
+    """Return True for rate limits, connection errors and 5xx responses; other 4xx errors (e.g. auth) are final."""
+    if isinstance(exc, (RateLimitError, APIConnectionError, InternalServerError, httpx.TransportError)):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code >= 500:
+        return True
+    return is_rate_limited(exc)
+
+def is_retryable_post_error(exc):
+    """Return True only for failures where the request cannot have been processed.
+
+    Used for non-idempotent POSTs: after a read timeout or 5xx the resource may already exist,
+    so retrying could create a duplicate.
+    """
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout)) or is_rate_limited(exc)
+
+# Exponential backoff with jitter for OpenAI and GitHub API calls
+api_retry = retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception(is_retryable_error),
+    reraise=True
+)
+
+# Same backoff for non-idempotent POSTs such as creating a review
+post_retry = retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception(is_retryable_post_error),
+    reraise=True
+)
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Settings for a single run, built once by Config.from_env() and passed to the functions that need them."""
+    openai_api_key: str
+    git_token: str
+    repo_name: str
+    pr_number: int
+    model: str = "gpt-4o-mini"
+    max_input_tokens: int = 7000  # Maximum length (tokens) of the input diff
+    max_output_tokens: int = 3000  # Review and line-specific suggestions share one completion
+    temperature: float = 0.3
+    force_review: bool = False
+    lines_change_threshold: int = 10
+    llm_cache: bool = False  # Reuse identical completions across re-runs
+    line_snap_distance: int = 3  # Maximum distance (lines) to move a suggestion onto a line that is part of the diff
+    summary_max_chars: int = 2000  # Maximum length (characters) of the previous review sent as context
+    log_level: str = "INFO"
+
+    @classmethod
+    def from_env(cls):
+        """Build the configuration from environment variables, exiting if a required one is missing or invalid."""
+        env = os.environ
+        required_vars = ["OPENAI_API_KEY", "GIT_TOKEN", "GIT_REPOSITORY", "PR_NUMBER"]
+        missing_vars = [var for var in required_vars if not env.get(var)]
+        if missing_vars:
+            log.error("❌ Missing required environment variables: %s", ', '.join(missing_vars))
+            sys.exit(1)
+
+        log_level = env.get("LOG_LEVEL", "INFO").upper()
+        if log_level not in logging.getLevelNamesMapping():
+            log.error("❌ Unknown LOG_LEVEL: %s", env["LOG_LEVEL"])
+            sys.exit(1)
+
+        return cls(
+            openai_api_key=env["OPENAI_API_KEY"],
+            git_token=env["GIT_TOKEN"],
+            repo_name=env["GIT_REPOSITORY"],
+            pr_number=int(env["PR_NUMBER"]),
+            llm_cache=env.get("LLM_CACHE") == "1",
+            log_level=log_level
+        )
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the tiktoken encoding for a model, loading it once per run."""
+    return tiktoken.encoding_for_model(model)
 
-def get_pr_diff(pr):
-    """Get the diff for a pull request."""
-    files = list(pr.get_files())  # Convert PaginatedList to regular list
-    diff = ""
-    for idx, file in enumerate(files):
-        diff += f"Filename: {file.filename}\n"
-        diff += f"Status: {file.status}\n"  # 'added', 'removed', 'modified'
-        diff += f"Patch (diff):\n{file.patch}\n"
-        if idx < len(files) - 1:
-            diff += "----" * 10 + "\n"
-    print(f"🔍 Diff length: {len(diff)} characters")
-    if len(diff) > MAX_INPUT_LENGTH:
-        print(f"🔍 Diff truncated to {MAX_INPUT_LENGTH} characters")
-
-    return diff[:MAX_INPUT_LENGTH]  # truncate if needed
-
-def generate_review(diff, client, existing_review=None):
-    """Generate review using OpenAI API with error handling."""
+def read_json_cache(cache_path):
+    """Return the JSON stored at cache_path, or None if it is missing or unreadable (treated as a cache miss)."""
     try:
-        # Prepare the system message
-        system_content = """You are an expert GitHub code reviewer.
-                          You are also a senior software & AI engineer with 10+ years of experience in machine learning, Python, and PyTorch.
-                          Provide constructive feedback on the PR diff.
-                          Deliver a compact, information-dense response and Focus on key points only.
-                          Focus on code quality, best practices, potential bugs, and improvement suggestions.
-                          If you are satisfied with the PR, you can just say "🤖 I'm satisfied with the PR".
-                          NOTE: Your response must be in Korean, but retain technical terms (e.g., PR, Github, CI, Docker, etc.) and the names of variables, functions, etc., in English.
-                          Here is the enhanced format for the review:
-                          1. **Summary of the PR**: Provide a brief overview of the purpose and scope of the pull request.
-                          2. **What's Changed?**: Highlight the key changes made in the codebase.
-                          3. **Improvement Suggestions**: Offer constructive feedback on how the code can be improved.
-                          4. **Code Quality**: Assess the readability, maintainability, and efficiency of the code.
-                          5. **Best Practices**: Evaluate adherence to coding standards and industry best practices.
-                          6. **Potential Bugs**: Identify any potential issues or bugs in the code.
-                        """
-                        #   7. **Testing and Validation**: Comment on the adequacy of tests and validation methods used.
-                        #   8. **Documentation**: Review the quality and completeness of documentation provided.
+        with open(cache_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_json_cache(cache_path, data):
+    """Write JSON to cache_path atomically, so an interrupted run never leaves a partial cache entry."""
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def create_github_client(git_token):
+    """Create the HTTP/2 keep-alive client shared by all GitHub API calls."""
+    return httpx.AsyncClient(
+        base_url=GITHUB_API_URL,
+        http2=True,
+        headers={
+            "Authorization": f"Bearer {git_token}",
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": "2022-11-28"
+        },
+        timeout=30
+    )
+
+async def send_github_request(gh, method, path, **kwargs):
+    """Send a GitHub API request over the shared client and return the decoded JSON body."""
+    response = await gh.request(method, path, **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+@api_retry
+async def github_request(gh, method, path, **kwargs):
+    """Send an idempotent GitHub API request, retrying on rate limits, connection errors and server errors."""
+    return await send_github_request(gh, method, path, **kwargs)
+
+@api_retry
+async def github_get(gh, path, params=None):
+    """GET a GitHub API resource, revalidating a locally cached copy with If-None-Match.
+
+    An unchanged resource comes back as 304 Not Modified, which has no body and does not count against the rate limit.
+    """
+    key = hashlib.sha256(json.dumps([path, params], sort_keys=True).encode()).hexdigest()
+    cache_path = os.path.join(ETAG_CACHE_DIR, f"{key}.json")
+    cached = read_json_cache(cache_path)
+    if not isinstance(cached, dict) or "etag" not in cached or "body" not in cached:
+        cached = None
+    headers = {"If-None-Match": cached["etag"]} if cached else {}
+
+    response = await gh.get(path, params=params, headers=headers)
+    if response.status_code == 304 and cached:
+        return cached["body"]
+    response.raise_for_status()
+    body = response.json()
+
+    etag = response.headers.get("etag")
+    if etag:
+        write_json_cache(cache_path, {"etag": etag, "body": body})
+    return body
+
+async def iter_pr_files(gh, pr):
+    """Yield the files changed in a PR, fetching the next page only when the previous one is consumed."""
+    page = 1
+    while True:
+        files = await github_get(gh, f"{pr['url']}/files", params={"per_page": FILES_PER_PAGE, "page": page})
+        for file in files:
+            yield file
+        if len(files) < FILES_PER_PAGE:
+            return
+        page += 1
+
+async def iter_list(items):
+    """Adapt an already fetched list to the async iteration expected by format_diff."""
+    for item in items:
+        yield item
+
+async def format_diff(cfg, files):
+    """Format changed files into a single diff of at most cfg.max_input_tokens tokens.
+
+    `files` is an async iterable; stopping early avoids fetching the remaining pages.
+    The file that overflows the budget is cut at hunk boundaries so the model never sees a partial hunk,
+    unless it is the first file and not even its first hunk fits, in which case that hunk is cut at a line boundary.
+    Returns the diff and the files that were included.
+    """
+    encoding = get_encoding(cfg.model)
+    parts = []
+    included_files = []
+    total_tokens = 0
+    async for file in files:
+        separator = "----" * 10 + "\n" if included_files else ""
+        # status: 'added', 'removed', 'modified'
+        header = f"{separator}Filename: {file['filename']}\nStatus: {file['status']}\nPatch (diff):\n"
+        chunk = f"{header}{file.get('patch')}\n"
+        chunk_tokens = len(encoding.encode(chunk))
+        if total_tokens + chunk_tokens <= cfg.max_input_tokens:
+            parts.append(chunk)
+            included_files.append(file)
+            total_tokens += chunk_tokens
+            continue
+
+        # Include as many whole hunks of this file as still fit, then stop
+        budget = cfg.max_input_tokens - total_tokens - len(encoding.encode(header))
+        all_hunks = HUNK_SPLIT_PATTERN.split(file.get("patch") or "")
+        hunks = []
+        for hunk in all_hunks:
+            hunk_tokens = len(encoding.encode(hunk + "\n"))
+            if hunk_tokens > budget:
+                break
+            hunks.append(hunk)
+            budget -= hunk_tokens
+        if not hunks and not included_files:
+            # Nothing would be sent at all (e.g. a huge added file, which is a single hunk),
+            # so keep the first hunk up to the last line that fits
+            lines = []
+            for line in all_hunks[0].split("\n"):
+                line_tokens = len(encoding.encode(line + "\n"))
+                if line_tokens > budget:
+                    break
+                lines.append(line)
+                budget -= line_tokens
+            if lines:
+                hunks.append("\n".join(lines))
+        if hunks:
+            parts.append(header + "\n".join(hunks) + "\n")
+            included_files.append(file)
+        log.info("🔍 Diff truncated to %d tokens", cfg.max_input_tokens)
+        break
+    return "".join(parts), included_files
+
+async def get_pr_diff(cfg, gh, pr):
+    """Get the diff for a pull request along with the fetched files."""
+    # Iterated lazily so only the needed pages are fetched
+    diff, files = await format_diff(cfg, iter_pr_files(gh, pr))
+    log.info("🔍 Diff length: %d characters", len(diff))
+
+    return diff, files
+
+def summarize_previous_review(cfg, review_body):
+    """Compress a previous review to its key lines so follow-up prompts stay small."""
+    key_lines = [line.strip() for line in review_body.splitlines() if REVIEW_KEY_LINE_PATTERN.match(line)]
+    summary = "\n".join(key_lines) or review_body
+    summary = summary[-cfg.summary_max_chars:]
+
+    encoding = get_encoding(cfg.model)
+    original_tokens = len(encoding.encode(review_body))
+    summary_tokens = len(encoding.encode(summary))
+    log.info("🔍 Previous review compressed: %d -> %d tokens", original_tokens, summary_tokens)
+
+    return summary
+
+@api_retry
+async def cached_chat_completion(cfg, client, **kwargs):
+    """Create a chat completion, reusing an on-disk response for identical requests when cfg.llm_cache is enabled."""
+    if not cfg.llm_cache:
+        return await client.chat.completions.create(**kwargs)
+
+    key = hashlib.sha256(json.dumps(kwargs, sort_keys=True).encode()).hexdigest()
+    cache_path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+    cached = read_json_cache(cache_path)
+    if cached is not None:
+        try:
+            response = ChatCompletion.model_validate(cached)
+            log.info("💾 Using cached completion (%s)", key[:12])
+            return response
+        except ValueError:
+            pass  # Unusable cache entry, request a fresh completion and overwrite it
+
+    response = await client.chat.completions.create(**kwargs)
+    # Truncated or refused responses must not be replayed on re-runs
+    if response.choices[0].finish_reason == "stop" and not response.choices[0].message.refusal:
+        write_json_cache(cache_path, response.model_dump(mode="json"))
+    return response
+
+def log_completion_usage(response):
+    """Log token usage and output length of a chat completion."""
+    log.info("🔍 Prompt tokens: %d tokens", response.usage.prompt_tokens)
+    details = response.usage.prompt_tokens_details
+    if details and details.cached_tokens is not None:
+        log.info("🔍 Cached prompt tokens: %d tokens", details.cached_tokens)
+    log.info("🔍 Completion tokens: %d tokens", response.usage.completion_tokens)
+    log.info("🔍 Total tokens: %d tokens", response.usage.total_tokens)
+    log.info("🔍 Completion length: %d characters", len(response.choices[0].message.content or ""))
+
+async def generate_review_and_suggestions(cfg, diff, client, previous_review=None):
+    """Generate the review and line-specific suggestions in a single OpenAI call with error handling."""
+    try:
+        # The base system prompt is kept byte-identical and placed first. It is too short (under 1024 tokens)
+        # to be cached alone, but it lets OpenAI's prompt cache match re-runs on the same diff once the
+        # whole prompt passes 1024 tokens
+        messages = [{"role": "system", "content": SYSTEM_PROMPT_BASE}]
         
         # Prepare the user message
         user_content = f"Please review this PR diff:\n\n{diff}"
         
         # If there's a previous review, add it as context
-        if existing_review:
-            system_content += "\n\nIMPORTANT: This is a follow-up review. \
-                               The diff represents changes since the last review. \
-                               Consider previous feedback and provide updated suggestions based on new changes. \
-                               Focus on what has changed since the last review. \
-                               Avoid repeating content from the previous review. \
-                               Identify and indicate which prior suggestions have been implemented and which require further attention. \
-                               Use ✅ to denote implemented suggestions and ❌ for those not yet addressed."
-            user_content += f"\n\nPrevious review:\n{existing_review.body}"
-        
-        print(f"🔍 System content length: {len(system_content)} characters")
-        print(f"🔍 User content length: {len(user_content)} characters")
-        if existing_review:
-            print(f"🔍 Existing review length: {len(existing_review.body)} characters")
-
-
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {
-                    "role": "system",
-                    "content": system_content
-                },
-                {
-                    "role": "user", 
-                    "content": user_content
-                }
-            ],
-            max_tokens=MAX_OUTPUT_TOKENS,
-            temperature=TEMPERATURE
+        if previous_review:
+            messages.append({"role": "system", "content": FOLLOWUP_ADDENDUM})
+            user_content += f"\n\nPrevious review:\n{previous_review}"
+        user_message = {"role": "user", "content": user_content}
+        messages.append(user_message)
+        
+        log.info("🔍 System content length: %d characters", sum(len(m['content']) for m in messages[:-1]))
+        log.info("🔍 User content length: %d characters", len(user_content))
+        if previous_review:
+            log.info("🔍 Previous review length: %d characters", len(previous_review))
+
+
+        max_tokens = cfg.max_output_tokens
+        response = await cached_chat_completion(
+            cfg,
+            client,
+            model=cfg.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=cfg.temperature,
+            response_format=REVIEW_RESPONSE_FORMAT
         )
-        print(f"🔍 Prompt tokens: {response.usage.prompt_tokens} tokens")
-        print(f"🔍 Completion tokens: {response.usage.completion_tokens} tokens")
-        print(f"🔍 Total tokens: {response.usage.total_tokens} tokens")
-        print(f"🔍 Completion length: {len(response.choices[0].message.content)} characters")
-        
-        return response.choices[0].message.content
+        log_completion_usage(response)
+        if response.choices[0].finish_reason == "length":
+            # Truncated JSON cannot be parsed, so retry once with a larger budget
+            max_tokens *= 2
+            log.warning("⚠️  Review hit the output token limit, retrying with %d tokens", max_tokens)
+            response = await cached_chat_completion(
+                cfg,
+                client,
+                model=cfg.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=cfg.temperature,
+                response_format=REVIEW_RESPONSE_FORMAT
+            )
+            log_completion_usage(response)
+        
+        choice = response.choices[0]
+        if choice.finish_reason == "stop" and choice.message.content:
+            # The response is constrained to REVIEW_RESPONSE_FORMAT, so a complete one parses directly
+            result = json.loads(choice.message.content)
+            return result["review_markdown"], result["suggestions"]
+        
+        # Still truncated or refused: fall back to a plain review so the run still posts something
+        log.warning(
+            "⚠️  Could not generate suggestions (finish_reason: %s, refusal: %s), requesting review only",
+            choice.finish_reason, choice.message.refusal
+        )
+        response = await cached_chat_completion(
+            cfg,
+            client,
+            model=cfg.model,
+            messages=messages[:-1] + [{"role": "system", "content": REVIEW_ONLY_ADDENDUM}, user_message],
+            max_tokens=max_tokens,
+            temperature=cfg.temperature
+        )
+        log_completion_usage(response)
+        review_text = response.choices[0].message.content
+        if not review_text:
+            raise RuntimeError(f"empty review (finish_reason: {response.choices[0].finish_reason})")
+        return review_text, []
     except Exception as e:
-        print(f"❌ Failed to generate review: {e}")
+        log.error("❌ Failed to generate review: %s", e)
         sys.exit(1)
 
-def check_existing_agent_review(pr):
+def count_changes_since(commit_nodes, commit_id):
+    """Sum (additions, deletions) of the commits made after commit_id, walking back from the head.
+
+    Returns None if commit_id is not among the nodes (e.g. force-pushed away or older than the fetched commits).
+    """
+    additions = deletions = 0
+    for node in reversed(commit_nodes):
+        if node["commit"]["oid"] == commit_id:
+            return additions, deletions
+        additions += node["commit"]["additions"]
+        deletions += node["commit"]["deletions"]
+    return None
+
+async def check_existing_agent_review(gh, pr):
     """Check if the agent has already reviewed this PR."""
     try:
-        reviews = pr.get_reviews()
-        if not reviews:
-            print("🤖 This is the first review")
+        # Fetch only the most recent reviews in one GraphQL call instead of paginating all of them
+        owner, name = pr["base"]["repo"]["full_name"].split("/")
+        data = await github_request(
+            gh, "POST", "/graphql",
+            json={"query": REVIEW_STATE_QUERY, "variables": {"owner": owner, "name": name, "number": pr["number"]}}
+        )
+        if "errors" in data:
+            raise RuntimeError(data["errors"])
+        pull_request = data["data"]["repository"]["pullRequest"]
+        reviews = pull_request["reviews"]["nodes"]
+        agent_reviews = [
+            review for review in reviews
+            if review["submittedAt"] and "🤖" in (review["body"] or "")
+        ]
+        if not agent_reviews:
+            log.info("🤖 This is the first review")
             return None
-        latest_agent_review = None
-        for review in reviews:
-            if "🤖" in review.body:
-                if latest_agent_review is None or review.submitted_at > latest_agent_review.submitted_at:
-                    latest_agent_review = review
-        if latest_agent_review:
-            print(f"⚠️  Latest agent review found (ID: {latest_agent_review.id})")
+        latest = max(agent_reviews, key=lambda review: review["submittedAt"])  # ISO 8601 sorts chronologically
+        commit_id = latest["commit"]["oid"] if latest["commit"] else None
+
+        latest_agent_review = AgentReview(
+            id=latest["databaseId"],
+            body=latest["body"],
+            commit_id=commit_id,
+            submitted_at=latest["submittedAt"],
+            changes_since=count_changes_since(pull_request["commits"]["nodes"], commit_id)
+        )
+        log.warning("⚠️  Latest agent review found (ID: %s)", latest_agent_review.id)
         return latest_agent_review
     except Exception as e:
-        print(f"❌ Failed to check existing reviews: {e}")
+        log.error("❌ Failed to check existing reviews: %s", e)
         return None
 
-def get_lines_changed_since_review(pr, last_review):
+# Comparisons already fetched in this run, keyed by (base SHA, head SHA)
+_comparisons = {}
+
+async def get_comparison(gh, pr, last_review):
+    """Compare the last reviewed commit with the PR head.
+
+    A comparison of two SHAs never changes, so it is kept in memory for this run and on disk
+    under COMPARE_CACHE_DIR for re-runs, and is never invalidated.
+    """
+    base_sha, head_sha = last_review.commit_id, pr["head"]["sha"]
+    key = (base_sha, head_sha)
+    if key in _comparisons:
+        return _comparisons[key]
+
+    cache_path = os.path.join(COMPARE_CACHE_DIR, f"{base_sha}_{head_sha}.json")
+    comparison = read_json_cache(cache_path)
+    if isinstance(comparison, dict) and "files" in comparison:
+        log.info("💾 Using cached comparison (%s...%s)", base_sha[:7], head_sha[:7])
+    else:
+        # Missing or unreadable cache entry: fetch from the API and overwrite it
+        repo_url = pr["base"]["repo"]["url"]
+        comparison = await github_request(gh, "GET", f"{repo_url}/compare/{base_sha}...{head_sha}")
+        write_json_cache(cache_path, comparison)
+
+    _comparisons[key] = comparison
+    return comparison
+
+async def get_lines_changed_since_review(gh, pr, last_review):
     """Get the number of lines changed since the last review."""
     try:
         # Get the commit SHA when the last review was submitted
         last_review_commit = last_review.commit_id
         
         # Get the current head commit
-        current_commit = pr.head.sha
+        current_commit = pr["head"]["sha"]
         
         # If it's the same commit, no changes
         if last_review_commit == current_commit:
             return 0
         
-        # Get the diff between the last review commit and current head
-        comparison = pr.base.repo.compare(last_review_commit, current_commit)
-        
-        total_additions = 0
-        total_deletions = 0
-        
-        for file in comparison.files:
-            total_additions += file.additions
-            total_deletions += file.deletions
+        if last_review.changes_since is not None:
+            # Counted from the review lookup, so no comparison (with patches) is needed here
+            total_additions, total_deletions = last_review.changes_since
+        else:
+            # The reviewed commit was not among the fetched commits (e.g. force-pushed), fall back to the comparison
+            comparison = await get_comparison(gh, pr, last_review)
+            
+            total_additions = 0
+            total_deletions = 0
+            
+            for file in comparison["files"]:
+                total_additions += file["additions"]
+                total_deletions += file["deletions"]
         
         total_changes = total_additions + total_deletions
-        print(f"📊 Lines changed since last review: +{total_additions} -{total_deletions} = {total_changes} total")
+        log.info("📊 Lines changed since last review: +%d -%d = %d total", total_additions, total_deletions, total_changes)
         
         return total_changes
         
     except Exception as e:
-        print(f"❌ Failed to get lines changed: {e}")
+        log.error("❌ Failed to get lines changed: %s", e)
         return 0
 
-def check_significant_update(pr, existing_review):
+async def check_significant_update(cfg, gh, pr, existing_review):
     """Check if we should force review due to significant changes."""
     try:
-        lines_changed = get_lines_changed_since_review(pr, existing_review)
+        lines_changed = await get_lines_changed_since_review(gh, pr, existing_review)
         
-        if lines_changed > LINES_CHANGE_THRESHOLD:
-            print(f"🔄 Significant changes detected ({lines_changed} lines > {LINES_CHANGE_THRESHOLD} lines (threshold))")
-            print(f"💡 Adding new review due to substantial changes")
+        if lines_changed > cfg.lines_change_threshold:
+            log.info("🔄 Significant changes detected (%d lines > %d lines (threshold))", lines_changed, cfg.lines_change_threshold)
+            log.info("💡 Adding new review due to substantial changes")
             return True
         else:
-            print(f"✅ Changes are minimal ({lines_changed} lines ≤ {LINES_CHANGE_THRESHOLD} lines (threshold))")
+            log.info("✅ Changes are minimal (%d lines ≤ %d lines (threshold))", lines_changed, cfg.lines_change_threshold)
             return False
             
     except Exception as e:
-        print(f"❌ Failed to check change threshold: {e}")
+        log.error("❌ Failed to check change threshold: %s", e)
         return False
 
-def should_proceed_with_review(pr, existing_review):
+async def should_proceed_with_review(cfg, gh, pr, existing_review):
     """Check if we should proceed with a new review based on existing agent reviews and changes."""
-    if FORCE_REVIEW:
-        print("🔄 Force review enabled - will regenerate even if review exists")
+    if cfg.force_review:
+        log.info("🔄 Force review enabled - will regenerate even if review exists")
         return True
     
     if existing_review:
-        return check_significant_update(pr, existing_review)
+        return await check_significant_update(cfg, gh, pr, existing_review)
 
     return True
 
-def get_diff_since_prev_review(pr, last_review):
-    """Get the diff for commits made after the last review."""
+async def get_diff_since_prev_review(cfg, gh, pr, last_review):
+    """Get the diff for commits made after the last review along with the changed files."""
     try:
         # Get the commit SHA when the last review was submitted
         last_review_commit = last_review.commit_id
         
         # Get the current head commit
-        current_commit = pr.head.sha
+        current_commit = pr["head"]["sha"]
         
         # If it's the same commit, no changes
         if last_review_commit == current_commit:
-            return ""
+            return "", []
         
         # Get the diff between the last review commit and current head
-        comparison = pr.base.repo.compare(last_review_commit, current_commit)
+        comparison = await get_comparison(gh, pr, last_review)
         
-        diff = ""
-        for idx, file in enumerate(comparison.files):
-            diff += f"Filename: {file.filename}\n"
-            diff += f"Status: {file.status}\n"  # 'added', 'removed', 'modified'
-            diff += f"Patch (diff):\n{file.patch}\n"
-            if idx < len(comparison.files) - 1:
-                diff += "----" * 10 + "\n"
+        diff, files = await format_diff(cfg, iter_list(comparison["files"]))
         
-        print(f"🔍 Diff since last review length: {len(diff)} characters")
-        if len(diff) > MAX_INPUT_LENGTH:
-            print(f"🔍 Diff since last review truncated to {MAX_INPUT_LENGTH} characters")
+        log.info("🔍 Diff since last review length: %d characters", len(diff))
         
-        return diff[:MAX_INPUT_LENGTH]  # truncate if needed
+        return diff, files
         
     except Exception as e:
-        print(f"❌ Failed to get diff since review: {e}")
-        return ""
+        log.error("❌ Failed to get diff since review: %s", e)
+        return "", []
 
-def generate_line_suggestions(diff, client, existing_review=None):
-    """Generate line-specific suggestions using OpenAI API."""
-    try:
-        system_content = """You are an expert code reviewer. Analyze the diff and provide specific line-by-line suggestions.
-                          For each suggestion, provide:
-                          1. The filename where the change should be made
-                          2. The exact line number (or range) where the change should be made
-                          3. The specific code change or suggestion
-                          4. A brief explanation of why this change is needed
-                          
-                          Format your response as a JSON array with objects containing:
-                          {
-                            "file": "<filename>",
-                            "line": <line_number>,
-                            "suggestion": "<specific code suggestion>",
-                            "explanation": "<brief explanation>"
-                          }
-                          
-                          Only provide suggestions for actual issues that need fixing.
-                          If no specific line changes are needed, return an empty array [].
-                          """
-        
-        user_content = f"Please analyze this diff and provide line-specific suggestions:\n\n{diff}"
-        
-        if existing_review:
-            user_content += f"\n\nPrevious review context:\n{existing_review.body}"
-        
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": system_content},
-                {"role": "user", "content": user_content}
-            ],
-            max_tokens=1000,
-            temperature=0.2
-        )
-        
-        suggestions_text = response.choices[0].message.content.strip()
-        
-        # Try to parse JSON response
-        try:
-            import json
-            suggestions = json.loads(suggestions_text)
-            if isinstance(suggestions, list):
-                return suggestions
-            else:
-                print("⚠️  Unexpected suggestions format, treating as general comment")
-                return []
-        except json.JSONDecodeError:
-            print("⚠️  Could not parse suggestions as JSON, treating as general comment")
-            return []
-            
-    except Exception as e:
-        print(f"❌ Failed to generate line suggestions: {e}")
-        return []
+def parse_diff_lines(files):
+    """Map each filename to the sorted new-file line numbers its patch covers.
 
-def post_review_with_suggestions(pr, review_text, suggestions, diff):
-    """Post review with both general comments and line-specific suggestions."""
-    try:
-        # Post the main review comment
-        pr.create_review(
-            body=f"## 🤖 PR Review Agent Suggestion\n\n{review_text}",
-            event="COMMENT"
-        )
-        
-        # Post line-specific suggestions if any
-        if suggestions:
-            print(f"📝 Posting {len(suggestions)} line-specific suggestions...")
-            
-            # Get all files in the PR for mapping
-            pr_files = {file.filename: file for file in pr.get_files()}
-            
-            for suggestion in suggestions:
-                try:
-                    filename = suggestion.get('file')
-                    line_num = suggestion.get('line')
-                    suggestion_text = suggestion.get('suggestion', '')
-                    explanation = suggestion.get('explanation', '')
-                    
-                    if filename and line_num and suggestion_text:
-                        # Check if the file exists in the PR
-                        if filename in pr_files:
-                            file = pr_files[filename]
-                            
-                            # Create the comment body
-                            comment_body = f"🤖 **Suggestion:**\n```\n{suggestion_text}\n```\n\n**Reason:** {explanation}"
-                            
-                            # Create a review comment on the specific line
-                            pr.create_review_comment(
-                                body=comment_body,
-                                commit_id=pr.head.sha,
-                                path=filename,
-                                position=line_num
-                            )
-                            print(f"✅ Posted suggestion for line {line_num} in {filename}")
-                        else:
-                            print(f"⚠️  File {filename} not found in PR, skipping suggestion")
-                    else:
-                        print(f"⚠️  Invalid suggestion format, skipping: {suggestion}")
-                        
-                except Exception as e:
-                    print(f"❌ Failed to post suggestion for {suggestion.get('file', 'unknown')}:{suggestion.get('line', 'unknown')}: {e}")
-                    continue
-        
-        print("✅ Successfully posted review with suggestions.")
-        
-    except Exception as e:
-        print(f"❌ Failed to post review: {e}")
-        sys.exit(1)
+    Only these lines (added or context) can carry an inline review comment.
+    """
+    diff_lines = {}
+    for file in files:
+        lines = []
+        line_num = None
+        # Split on "\n" only: str.splitlines() also breaks on characters such as \x0c that can appear inside a line
+        for patch_line in (file.get("patch") or "").split("\n"):
+            header = HUNK_HEADER_PATTERN.match(patch_line)
+            if header:
+                line_num = int(header.group(1))
+            elif line_num is not None and patch_line[:1] in ("+", " "):
+                lines.append(line_num)
+                line_num += 1
+        diff_lines[file["filename"]] = lines
+    return diff_lines
 
-def main():
-    """Main function to run the PR review agent."""
-    print("🤖 Starting PR Review Agent...")
-    
-    # Validate environment variables
-    validate_environment()
-    
-    # Load configuration
-    openai_api_key = os.environ.get("OPENAI_API_KEY")
-    git_token = os.environ.get("GIT_TOKEN")
-    repo_name = os.environ.get("GIT_REPOSITORY")
-    pr_number = int(os.environ.get("PR_NUMBER"))
+def intersect_diff_lines(diff_lines, other_diff_lines):
+    """Keep only the lines of diff_lines that other_diff_lines also covers for the same file."""
+    return {
+        filename: sorted(set(lines).intersection(other_diff_lines.get(filename, ())))
+        for filename, lines in diff_lines.items()
+    }
+
+def snap_to_diff_line(line_num, lines, max_distance):
+    """Return the diff line closest to line_num, or None if none is within max_distance."""
+    if not lines:
+        return None
+    index = bisect.bisect_left(lines, line_num)
+    nearest = min(lines[max(index - 1, 0):index + 1], key=lambda line: abs(line - line_num))
+    return nearest if abs(nearest - line_num) <= max_distance else None
+
+@post_retry
+async def submit_review(gh, pr, **kwargs):
+    """Create a review on the PR head commit the diff was taken from."""
+    return await send_github_request(
+        gh, "POST", f"{pr['url']}/reviews", json={"commit_id": pr["head"]["sha"], **kwargs}
+    )
+
+async def post_review_with_suggestions(cfg, gh, pr, review_text, suggestions, diff_lines):
+    """Post review with both general comments and line-specific suggestions in a single request.
+
+    Suggestions are checked against `diff_lines` (see parse_diff_lines) before posting, since a single
+    line outside the diff makes GitHub reject the whole review.
+    """
+    body = f"## 🤖 PR Review Agent Suggestion\n\n{review_text}"
+    inline_comments = []
+    for suggestion in suggestions:
+        line_num = snap_to_diff_line(suggestion["line"], diff_lines.get(suggestion["file"]), cfg.line_snap_distance)
+        if line_num is None:
+            continue
+        inline_comments.append({
+            "path": suggestion["file"],
+            "line": line_num,
+            "side": "RIGHT",
+            "body": SUGGESTION_COMMENT_TEMPLATE.format_map(suggestion)
+        })
+    if suggestions:
+        log.info("📝 Posting %d line-specific suggestions...", len(inline_comments))
+    skipped = len(suggestions) - len(inline_comments)
+    if skipped:
+        log.warning("⚠️  Skipped %d suggestions outside the diff", skipped)
 
-    # Initialize clients
     try:
-        gh = Github(git_token)
-        print(f"🔐 Authenticated as: {gh.get_user().login}")
-        
-        repo = gh.get_repo(repo_name)
-        print(f"📁 Repository: {repo.full_name}")
-        print(f"🔗 Repository URL: {repo.html_url}")
-        
-        pr = repo.get_pull(pr_number)
-        print(f"✅ PR #{pr_number} found successfully")
-        print(f"📋 PR Title: {pr.title}")
-        print(f"👤 Author: {pr.user.login}")
-        print(f"📊 PR State: {pr.state}")
-        
-        client = OpenAI(api_key=openai_api_key)
+        await submit_review(gh, pr, body=body, event="COMMENT", comments=inline_comments)
     except Exception as e:
-        print(f"❌ Failed to initialize clients: {e}")
-        sys.exit(1)
-    
-    print(f"📋 Reviewing PR #{pr_number} in {repo_name}")
+        # Only a validation error (422) guarantees no review was created; anything else may have posted it
+        rejected = isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 422
+        if not inline_comments or not rejected:
+            log.error("❌ Failed to post review: %s", e)
+            sys.exit(1)
+        # A single invalid line rejects the whole batch, so keep at least the main review
+        log.warning("⚠️  Failed to post line-specific suggestions, posting review only: %s", e)
+        try:
+            await submit_review(gh, pr, body=body, event="COMMENT")
+        except Exception as e:
+            log.error("❌ Failed to post review: %s", e)
+            sys.exit(1)
 
+    log.info("✅ Successfully posted review with suggestions.")
+
+async def review_pull_request(cfg, gh, client, pr):
+    """Review a pull request and post the result, reusing the shared GitHub client for every call."""
     # Check for existing review once
-    existing_review = check_existing_agent_review(pr)
+    existing_review = await check_existing_agent_review(gh, pr)
     
-    if not should_proceed_with_review(pr, existing_review):
+    if not await should_proceed_with_review(cfg, gh, pr, existing_review):
         return
 
     # Get PR diff
     if existing_review:
-        print("📋 Getting diff since last review...")
-        diff = get_diff_since_prev_review(pr, existing_review)
+        log.info("📋 Getting diff since last review...")
+        diff, files = await get_diff_since_prev_review(cfg, gh, pr, existing_review)
     else:
-        print("📋 Getting full PR diff...")
-        diff = get_pr_diff(pr)
+        log.info("📋 Getting full PR diff...")
+        diff, files = await get_pr_diff(cfg, gh, pr)
         
     if not diff.strip():
-        print("⚠️  No changes found in PR diff")
+        log.warning("⚠️  No changes found in PR diff")
         return
         
-    # Generate review
-    print("🤖 Generating review...")
+    # Generate review and line-specific suggestions
+    log.info("🤖 Generating review and line-specific suggestions...")
+    previous_review = None
     if existing_review:
-        print("📋 Including previous review as context...")
-    review_text = generate_review(diff, client, existing_review)
-
-    # Generate line-specific suggestions
-    print("🤖 Generating line-specific suggestions...")
-    suggestions = generate_line_suggestions(diff, client, existing_review)
+        log.info("📋 Including previous review as context...")
+        previous_review = summarize_previous_review(cfg, existing_review.body)
+    review_text, suggestions = await generate_review_and_suggestions(cfg, diff, client, previous_review)
 
     # Post review with suggestions
-    print("🤖 Posting review with suggestions...")
-    post_review_with_suggestions(pr, review_text, suggestions, diff)
+    log.info("🤖 Posting review with suggestions...")
+    diff_lines = parse_diff_lines(files)
+    if existing_review:
+        # Comments are posted on the PR's own diff, which the comparison can exceed
+        # (e.g. after merging the base branch), so keep only lines covered by both
+        pr_diff_lines = parse_diff_lines([file async for file in iter_pr_files(gh, pr)])
+        diff_lines = intersect_diff_lines(diff_lines, pr_diff_lines)
+    await post_review_with_suggestions(cfg, gh, pr, review_text, suggestions, diff_lines)
+
+async def main():
+    """Main function to run the PR review agent."""
+    # Load and validate configuration once
+    cfg = Config.from_env()
+    logging.basicConfig(level=cfg.log_level, format="%(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # Skip per-request logs from the GitHub client
+    log.info("🤖 Starting PR Review Agent...")
+
+    # Initialize clients
+    gh = create_github_client(cfg.git_token)
+    try:
+        # The PR payload already carries the repository details, so no separate repository lookup is needed
+        user, pr = await asyncio.gather(
+            github_get(gh, "/user"),
+            github_get(gh, f"/repos/{cfg.repo_name}/pulls/{cfg.pr_number}")
+        )
+        log.info("🔐 Authenticated as: %s", user['login'])
+        log.info("📁 Repository: %s", pr['base']['repo']['full_name'])
+        log.info("🔗 Repository URL: %s", pr['base']['repo']['html_url'])
+        log.info("✅ PR #%d found successfully", cfg.pr_number)
+        log.info("📋 PR Title: %s", pr['title'])
+        log.info("👤 Author: %s", pr['user']['login'])
+        log.info("📊 PR State: %s", pr['state'])
+        
+        client = AsyncOpenAI(api_key=cfg.openai_api_key, max_retries=0)  # Retries are handled by api_retry
+    except Exception as e:
+        log.error("❌ Failed to initialize clients: %s", e)
+        await gh.aclose()
+        sys.exit(1)
+    
+    log.info("📋 Reviewing PR #%d in %s", cfg.pr_number, cfg.repo_name)
+
+    try:
+        await review_pull_request(cfg, gh, client, pr)
+    finally:
+        await gh.aclose()
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
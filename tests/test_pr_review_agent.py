@@ -0,0 +1,146 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import pr_review_agent  # noqa: E402
+
+
+class WhitespaceEncoding:
+    """Stand-in for a tiktoken encoding that counts whitespace-separated words as tokens."""
+
+    def encode(self, text):
+        return text.split()
+
+
+def run_format_diff(files, max_input_tokens, monkeypatch):
+    monkeypatch.setattr(pr_review_agent, "get_encoding", lambda model: WhitespaceEncoding())
+    cfg = pr_review_agent.Config(
+        openai_api_key="key", git_token="token", repo_name="owner/repo", pr_number=1,
+        max_input_tokens=max_input_tokens
+    )
+    return asyncio.run(pr_review_agent.format_diff(cfg, pr_review_agent.iter_list(files)))
+
+
+def test_format_diff_cuts_oversized_first_hunk_at_line_boundary(monkeypatch):
+    added_lines = [f"+line{i}" for i in range(100)]
+    big_added = {"filename": "big.py", "status": "added", "patch": "@@ -0,0 +1,100 @@\n" + "\n".join(added_lines)}
+    small = {"filename": "small.py", "status": "modified", "patch": "@@ -1 +1 @@\n-a\n+b"}
+
+    diff, files = run_format_diff([big_added, small], max_input_tokens=50, monkeypatch=monkeypatch)
+
+    assert files == [big_added]
+    assert "Filename: big.py" in diff
+    assert "@@ -0,0 +1,100 @@\n+line0\n" in diff
+    assert "+line99" not in diff
+    assert len(diff.split()) <= 50
+
+
+def test_format_diff_keeps_whole_hunks_after_first_file(monkeypatch):
+    small = {"filename": "small.py", "status": "modified", "patch": "@@ -1 +1 @@\n-a\n+b"}
+    two_hunks = {
+        "filename": "two.py", "status": "modified",
+        "patch": "@@ -1 +1 @@\n-c\n+d\n@@ -10 +10 @@\n" + "\n".join(f"+x{i}" for i in range(50))
+    }
+
+    diff, files = run_format_diff([small, two_hunks], max_input_tokens=30, monkeypatch=monkeypatch)
+
+    assert files == [small, two_hunks]
+    assert "@@ -1 +1 @@\n-c\n+d\n" in diff
+    assert "@@ -10 +10 @@" not in diff
+
+
+def commit_node(oid, additions, deletions):
+    return {"commit": {"oid": oid, "additions": additions, "deletions": deletions}}
+
+
+COMMIT_NODES = [commit_node("a", 1, 2), commit_node("b", 3, 4), commit_node("c", 5, 6)]
+
+
+def test_count_changes_since_sums_commits_after_reviewed_one():
+    assert pr_review_agent.count_changes_since(COMMIT_NODES, "a") == (8, 10)
+
+
+def test_count_changes_since_reviewed_head_is_zero():
+    assert pr_review_agent.count_changes_since(COMMIT_NODES, "c") == (0, 0)
+
+
+def test_count_changes_since_missing_commit_is_none():
+    assert pr_review_agent.count_changes_since(COMMIT_NODES, "force-pushed") is None
+    assert pr_review_agent.count_changes_since(COMMIT_NODES, None) is None
+
+
+def test_parse_diff_lines_counts_added_and_context_lines_across_hunks():
+    patch = (
+        "@@ -1,3 +1,3 @@\n a\n-b\n+c\n d\n"
+        "@@ -20 +20,2 @@\n+e\n f\n"
+        "@@ -40,0 +41 @@\n+g"
+    )
+
+    assert pr_review_agent.parse_diff_lines([{"filename": "f.py", "patch": patch}]) == {"f.py": [1, 2, 3, 20, 21, 41]}
+
+
+def test_parse_diff_lines_skips_deleted_lines_and_no_newline_marker():
+    patch = "@@ -1,2 +1,2 @@\n-a\n-b\n\\ No newline at end of file\n+c\n+d\n\\ No newline at end of file"
+
+    assert pr_review_agent.parse_diff_lines([{"filename": "f.py", "patch": patch}]) == {"f.py": [1, 2]}
+
+
+def test_parse_diff_lines_splits_on_newlines_only():
+    patch = "@@ -1,2 +1,2 @@\n a\x0c+b c\n+d\r+e"
+
+    assert pr_review_agent.parse_diff_lines([{"filename": "f.py", "patch": patch}]) == {"f.py": [1, 2]}
+
+
+def test_parse_diff_lines_without_patch_has_no_lines():
+    assert pr_review_agent.parse_diff_lines([{"filename": "image.png"}]) == {"image.png": []}
+
+
+def test_snap_to_diff_line_moves_up_to_max_distance():
+    lines = [10, 11, 20]
+
+    assert pr_review_agent.snap_to_diff_line(11, lines, 3) == 11
+    assert pr_review_agent.snap_to_diff_line(14, lines, 3) == 11
+    assert pr_review_agent.snap_to_diff_line(15, lines, 3) is None
+    assert pr_review_agent.snap_to_diff_line(17, lines, 3) == 20
+    assert pr_review_agent.snap_to_diff_line(7, lines, 3) == 10
+    assert pr_review_agent.snap_to_diff_line(6, lines, 3) is None
+    assert pr_review_agent.snap_to_diff_line(23, lines, 3) == 20
+    assert pr_review_agent.snap_to_diff_line(24, lines, 3) is None
+
+
+def test_snap_to_diff_line_unknown_file_is_none():
+    diff_lines = {"f.py": [1, 2]}
+
+    assert pr_review_agent.snap_to_diff_line(1, diff_lines.get("other.py"), 3) is None
+    assert pr_review_agent.snap_to_diff_line(1, [], 3) is None
+
+
+def test_intersect_diff_lines_keeps_lines_in_both_diffs():
+    comparison_lines = {"f.py": [1, 2, 3, 10], "merged_from_base.py": [1, 2]}
+    pr_lines = {"f.py": [2, 3, 4], "other.py": [5]}
+
+    assert pr_review_agent.intersect_diff_lines(comparison_lines, pr_lines) == {"f.py": [2, 3], "merged_from_base.py": []}
+
+
+def set_required_env(monkeypatch):
+    for var, value in {"OPENAI_API_KEY": "key", "GIT_TOKEN": "token", "GIT_REPOSITORY": "owner/repo", "PR_NUMBER": "1"}.items():
+        monkeypatch.setenv(var, value)
+
+
+def test_config_from_env_normalises_log_level(monkeypatch):
+    set_required_env(monkeypatch)
+    monkeypatch.setenv("LOG_LEVEL", "debug")
+
+    assert pr_review_agent.Config.from_env().log_level == "DEBUG"
+
+
+def test_config_from_env_exits_on_unknown_log_level(monkeypatch):
+    set_required_env(monkeypatch)
+    monkeypatch.setenv("LOG_LEVEL", "verbose")
+
+    with pytest.raises(SystemExit):
+        pr_review_agent.Config.from_env()